@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the strip-parallel reduce and resize.
+
+Resizes synthetic RGB and RGBA images on 1 to N threads, with a pure
+LANCZOS pass and with every downscale quality preset, and reports the time
+taken, the speedup over the serial resize and the max difference per
+channel from the serial output, which must be 0.
+
+Usage:
+    python benchmarks/bench_parallel.py [--mpx 100] [--threads 1 2 4 8 16]
+"""
+
+import argparse
+import os
+import sys
+
+from PIL import Image, ImageChops
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import resampling  # noqa: E402
+from bench_resampling import synthetic_image, timed  # noqa: E402
+
+
+def with_alpha(pil_img):
+    """Return a RGBA copy of the image with a mostly low alpha gradient,
+    where premultiplied rounding errors are the most amplified."""
+    alpha = Image.linear_gradient("L").resize(pil_img.size)
+    rgba = pil_img.convert("RGBA")
+    rgba.putalpha(alpha.point(lambda value: value // 4))
+    return rgba
+
+
+def max_difference(image1, image2):
+    """Return the max difference per channel between two images."""
+    return max(high for _, high in ImageChops.difference(image1, image2).getextrema())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mpx", type=float, default=100)
+    parser.add_argument("--size", type=int, nargs=2, default=[1000, 1000])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rgb = synthetic_image(args.mpx)
+    rgb.load()
+    size = resampling.fit_size(rgb.size, *args.size)
+    print(
+        "CPUs: {}, source: {}x{}, output: {}x{}".format(
+            os.cpu_count(), rgb.size[0], rgb.size[1], size[0], size[1]
+        )
+    )
+    print(
+        "{:>5} {:>9} {:>8} {:>10} {:>8} {:>9}".format(
+            "mode", "method", "threads", "time (s)", "speedup", "max diff"
+        )
+    )
+
+    for source in (rgb, with_alpha(rgb)):
+        methods = [
+            (
+                "lanczos",
+                lambda threads: resampling.resize_parallel(
+                    source, size, resampling.LANCZOS, threads=threads
+                ),
+            )
+        ]
+        for quality in resampling.QUALITIES:
+            methods.append(
+                (
+                    quality,
+                    lambda threads, q=quality: resampling.downscale(
+                        source, size[0], size[1], q, threads
+                    ),
+                )
+            )
+
+        for name, function in methods:
+            serial, serial_time = timed(lambda: function(1), args.repeat)
+            for threads in args.threads:
+                thumb, elapsed = timed(lambda: function(threads), args.repeat)
+                print(
+                    "{:>5} {:>9} {:>8} {:>10.3f} {:>8.2f} {:>9}".format(
+                        source.mode,
+                        name,
+                        threads,
+                        elapsed,
+                        serial_time / elapsed,
+                        max_difference(serial, thumb),
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the resampling engine quality presets.
+
+Downscales synthetic 24 to 100 megapixel images with every preset and with
+the legacy two-step thumbnail pipeline, and reports the time taken and the
+PSNR against a pure LANCZOS resize of the same image.
+
+Usage:
+    python benchmarks/bench_resampling.py [--mpx 24 50 100] [--size 200 200]
+"""
+
+import argparse
+import math
+import os
+import sys
+import time
+
+from PIL import Image, ImageChops, ImageStat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import resampling  # noqa: E402
+
+
+def synthetic_image(megapixels):
+    """Return a 3:2 RGB image with fine detail and smooth gradients."""
+    height = int(math.sqrt(megapixels * 1e6 / 1.5))
+    width = int(height * 1.5)
+    detail = Image.effect_mandelbrot((width, height), (-2.0, -1.0, 1.0, 1.0), 256)
+    noise = Image.effect_noise((width, height), 48)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    return Image.merge("RGB", (detail, noise, gradient))
+
+
+def legacy_thumbnail(pil_img, target_w, target_h):
+    """The former two-step pipeline: default quality thumbnail of a copy to
+    double the target size, then a LANCZOS thumbnail in place."""
+    img_w, img_h = pil_img.size
+    if img_w > target_w * 2 or img_h > target_h * 2:
+        pil_img = pil_img.copy()
+        pil_img.thumbnail((target_w * 2, target_h * 2))
+    pil_img.thumbnail((target_w, target_h), resampling.LANCZOS)
+    return pil_img
+
+
+def psnr(image1, image2):
+    """Return the peak signal-to-noise ratio in dB between two images."""
+    rms = ImageStat.Stat(ImageChops.difference(image1, image2)).rms
+    mse = sum(value**2 for value in rms) / len(rms)
+    if not mse:
+        return float("inf")
+    return 10 * math.log10(255.0**2 / mse)
+
+
+def timed(function, repeat):
+    """Return the result and the best time in seconds of `repeat` runs."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mpx", type=float, nargs="+", default=[24, 50, 100])
+    parser.add_argument("--size", type=int, nargs=2, default=[200, 200])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    target_w, target_h = args.size
+
+    print("{:>6} {:>10} {:>10} {:>10}".format("MPx", "method", "time (s)", "PSNR (dB)"))
+    for megapixels in args.mpx:
+        source = synthetic_image(megapixels)
+        source.load()
+        reference = resampling.downscale(source, target_w, target_h, "exact")
+
+        methods = [("legacy", lambda: legacy_thumbnail(source, target_w, target_h))]
+        for quality in resampling.QUALITIES:
+            methods.append(
+                (
+                    quality,
+                    lambda q=quality: resampling.downscale(
+                        source, target_w, target_h, q
+                    ),
+                )
+            )
+
+        for name, function in methods:
+            thumb, elapsed = timed(function, args.repeat)
+            print(
+                "{:>6g} {:>10} {:>10.3f} {:>10.2f}".format(
+                    megapixels, name, elapsed, psnr(reference, thumb)
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
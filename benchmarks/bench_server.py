@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""
+Load generator for the thumbnail server.
+
+Starts server.py on localhost serving synthetic images, then keeps a number
+of keep-alive clients requesting a mix of thumbnails for a while, and
+reports the requests per second and the latency percentiles. Every distinct
+thumbnail is rendered once, the rest of the requests are served from the
+caches or share a render in progress.
+
+Usage:
+    python benchmarks/bench_server.py [--clients 32] [--duration 10]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_resampling import synthetic_image  # noqa: E402
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server.py")
+
+
+def free_port():
+    """Return a free TCP port on localhost."""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+async def wait_server(port, timeout=30):
+    """Wait until the server accepts connections."""
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return
+
+
+async def client(port, targets, deadline, latencies, errors):
+    """Request random targets on a keep-alive connection until deadline."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    while time.perf_counter() < deadline:
+        target = random.choice(targets)
+        start = time.perf_counter()
+        writer.write(
+            "GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(target).encode("ascii")
+        )
+        await writer.drain()
+        status = (await reader.readline()).split()[1]
+        length = 0
+        while True:
+            line = await reader.readline()
+            if not line.strip():
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        await reader.readexactly(length)
+        latencies.append(time.perf_counter() - start)
+        if status != b"200":
+            errors.append(status)
+    writer.close()
+
+
+def percentile(values, fraction):
+    """Return the value at a fraction of the sorted values."""
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def run(port, targets, clients, duration):
+    """Run the clients and return the latencies, errors and time taken."""
+    await wait_server(port)
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[
+            client(port, targets, start + duration, latencies, errors)
+            for _ in range(clients)
+        ]
+    )
+    return latencies, errors, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--mpx", type=float, default=24)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 200, 400])
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    cache_dir = os.path.join(root, "cache")
+    os.makedirs(cache_dir)
+    targets = []
+    for index in range(args.images):
+        name = "image{}.png".format(index)
+        synthetic_image(args.mpx).save(os.path.join(root, name), compress_level=1)
+        targets.extend(
+            "/thumb?src={}&w={}&h={}".format(name, size, size) for size in args.sizes
+        )
+
+    port = free_port()
+    command = [sys.executable, SERVER, "--root", root, "--port", str(port)]
+    command += ["--cache-dir", cache_dir]
+    if args.workers:
+        command += ["--workers", str(args.workers)]
+    server = subprocess.Popen(command)
+    try:
+        latencies, errors, elapsed = asyncio.run(
+            run(port, targets, args.clients, args.duration)
+        )
+    finally:
+        # Interrupt the server so it shuts its worker processes down too
+        server.send_signal(signal.SIGINT)
+        server.wait()
+        shutil.rmtree(root)
+
+    latencies.sort()
+    print("Distinct thumbnails: {}, clients: {}".format(len(targets), args.clients))
+    print("Requests: {}, errors: {}".format(len(latencies), len(errors)))
+    print("Requests/sec: {:.1f}".format(len(latencies) / elapsed))
+    for name, fraction in (("p50", 0.5), ("p99", 0.99), ("max", 1)):
+        print(
+            "Latency {}: {:.2f} ms".format(name, percentile(latencies, fraction) * 1000)
+        )
+
+
+if __name__ == "__main__":
+    main()
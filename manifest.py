@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+"""
+MiniaturEasy crop manifest
+
+Every thumbnail saved from the GUI is appended as a JSON line to a manifest
+file, holding the crop box in source image pixels, the rotation applied and
+the thumbnail size, quality and pathname.
+
+Running this module replays a manifest without the GUI, so all the
+thumbnails can be rendered again at another size or format:
+
+    python manifest.py MANIFEST --size 400 400 [--format png] --output-dir DIR
+
+Without --output-dir the thumbnails are overwritten in place, which
+requires --force.
+
+Thumbnails are rendered in parallel processes and appended to the manifest
+too, with the output of the GUI thumbnail as `origin`, so those already
+rendered with the same settings from an unchanged source image are skipped
+unless --force. Only the GUI thumbnails are ever replayed.
+
+@author: Benito López
+@license: GNU GPL v3
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+import resampling
+
+DEFAULT_MANIFEST = os.path.join(os.path.expanduser("~"), ".miniatureasy_manifest.jsonl")
+# Formats allowed for the thumbnails by file extension
+FORMATS = {"jpg": ".jpg", "png": ".png", "ico": ".ico"}
+# Image modes that can be saved as JPEG
+JPEG_MODES = ("1", "L", "RGB", "CMYK")
+
+
+def unrotate_box(box, size, rotation):
+    """Return the crop box of an image rotated 90º to the right `rotation`
+    times in the coordinates of the original image.
+
+    `size` is the size of the rotated image."""
+    left, top, right, bottom = box
+    width, height = size
+    for _ in range(rotation % 4):
+        left, top, right, bottom = top, width - right, bottom, width - left
+        width, height = height, width
+    return left, top, right, bottom
+
+
+def file_stamp(path):
+    """Return the modification time and size in bytes of a file."""
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+
+def make_entry(source, rotated_size, box, rotation, size, quality, output):
+    """Return a manifest entry for a thumbnail.
+
+    `box` is the crop box in pixels of the source image rotated 90º to the
+    right `rotation` times, and `rotated_size` the size of the rotated image."""
+    mtime, nbytes = file_stamp(source)
+    source_size = rotated_size[::-1] if rotation % 2 else rotated_size
+    return {
+        "source": os.path.abspath(source),
+        "source_mtime": mtime,
+        "source_bytes": nbytes,
+        "source_size": list(source_size),
+        "box": list(unrotate_box(box, rotated_size, rotation)),
+        "rotation": rotation % 4,
+        "size": list(size),
+        "quality": quality,
+        "output": os.path.abspath(output),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def append_entry(manifest_path, entry):
+    """Append an entry to the manifest file as a JSON line."""
+    with open(manifest_path, "a") as manifest:
+        manifest.write(json.dumps(entry, sort_keys=True) + "\n")
+
+
+def read_entries(manifest_path):
+    """Return the GUI entries and the replay entries of the manifest by
+    output, only the last one of every output."""
+    entries = {}
+    replays = {}
+    with open(manifest_path) as manifest:
+        for number, line in enumerate(manifest, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logging.warning("%s:%s: invalid entry skipped", manifest_path, number)
+                continue
+            if "origin" in entry:
+                replays[entry["output"]] = entry
+            else:
+                entries[entry["output"]] = entry
+    return entries, replays
+
+
+def render(entry, size, quality):
+    """Return the thumbnail of a manifest entry at size and quality.
+
+    The crop box is scaled from the source image and only the thumbnail is
+    rotated."""
+    img = Image.open(entry["source"])
+    rotation = entry["rotation"]
+    width, height = size[::-1] if rotation % 2 else size
+    thumb = resampling.downscale(img, width, height, quality, box=entry["box"])
+    if rotation:
+        thumb = thumb.rotate(-90 * rotation, expand=True)
+    return thumb
+
+
+def output_path(entry, fmt=None, output_dir=None, base_dir=None):
+    """Return the replay output pathname of an entry.
+
+    With `output_dir` the pathname keeps its directory relative to
+    `base_dir`, so thumbnails with the same name don't overwrite each other."""
+    path = entry["output"]
+    if fmt:
+        path = os.path.splitext(path)[0] + FORMATS[fmt]
+    if output_dir:
+        path = os.path.join(output_dir, os.path.relpath(path, base_dir))
+    return os.path.abspath(path)
+
+
+def skip_reason(entry, rendered, size, quality):
+    """Return why an entry must not be replayed or None to render it.
+
+    `rendered` is the last manifest entry of the replay output, if any."""
+    try:
+        stamp = file_stamp(entry["source"])
+    except OSError:
+        return "source not found"
+    if stamp != (entry["source_mtime"], entry["source_bytes"]):
+        try:
+            with Image.open(entry["source"]) as img:
+                source_size = list(img.size)
+        except (IOError, OSError, Image.DecompressionBombError) as error:
+            return "source not readable ({})".format(error)
+        if source_size != entry["source_size"]:
+            return "source size changed, crop box no longer valid"
+    if not rendered or not os.path.exists(rendered["output"]):
+        return None
+    same = (
+        stamp == (rendered["source_mtime"], rendered["source_bytes"])
+        and rendered["source"] == entry["source"]
+        and rendered["box"] == entry["box"]
+        and rendered["rotation"] == entry["rotation"]
+        and rendered["size"] == list(size)
+        and rendered["quality"] == quality
+    )
+    return "unchanged" if same else None
+
+
+def replay_entry(entry, path, size, quality):
+    """Render and save the thumbnail of a GUI entry.
+
+    Return the manifest entry of the new thumbnail, with the GUI thumbnail
+    output as origin."""
+    thumb = render(entry, size, quality)
+    if path.endswith(".jpg") and thumb.mode not in JPEG_MODES:
+        thumb = thumb.convert("RGB")
+    thumb.save(path, optimize=True)
+    mtime, nbytes = file_stamp(entry["source"])
+    return dict(
+        entry,
+        source_mtime=mtime,
+        source_bytes=nbytes,
+        size=list(size),
+        quality=quality,
+        output=os.path.abspath(path),
+        origin=entry["output"],
+        time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+    )
+
+
+def replay(
+    manifest_path,
+    size=None,
+    fmt=None,
+    quality=None,
+    output_dir=None,
+    jobs=None,
+    force=False,
+):
+    """Render again all the GUI thumbnails of a manifest in parallel
+    processes and append them to the manifest.
+
+    Without `output_dir` the thumbnails are overwritten in place. The
+    entries of previous replays are only used to skip the unchanged ones.
+
+    Return the number of thumbnails rendered, skipped and failed."""
+    rendered = skipped = failed = 0
+    sources, replays = read_entries(manifest_path)
+    sources = list(sources.values())
+    base_dir = None
+    if output_dir and sources:
+        base_dir = os.path.commonpath(
+            [os.path.dirname(entry["output"]) for entry in sources]
+        )
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        queued = {}
+        for entry in sources:
+            path = output_path(entry, fmt, output_dir, base_dir)
+            if path in queued:
+                logging.error(
+                    "Cannot create thumbnail: %s (same output as %s)",
+                    entry["output"],
+                    queued[path],
+                )
+                failed += 1
+                continue
+            queued[path] = entry["output"]
+            entry_size = size or entry["size"]
+            entry_quality = quality or entry["quality"]
+            last = replays.get(path)
+            reason = skip_reason(entry, last, entry_size, entry_quality)
+            if reason == "unchanged" and force:
+                reason = None
+            if reason:
+                logging.info("Skipped %s: %s", path, reason)
+                skipped += 1
+                continue
+            try:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+            except (IOError, OSError) as error:
+                logging.error("Cannot create thumbnail: %s (%s)", path, error)
+                failed += 1
+                continue
+            futures.append(
+                (
+                    path,
+                    executor.submit(
+                        replay_entry, entry, path, entry_size, entry_quality
+                    ),
+                )
+            )
+
+        for path, future in futures:
+            try:
+                append_entry(manifest_path, future.result())
+            except Exception as error:
+                # Any worker error only fails its own thumbnail
+                logging.error("Cannot create thumbnail: %s (%s)", path, error)
+                failed += 1
+            else:
+                logging.info("Saved: %s", path)
+                rendered += 1
+    return rendered, skipped, failed
+
+
+def main():
+    """Parse the command line and replay a manifest."""
+    parser = argparse.ArgumentParser(
+        description="Render again the thumbnails of a MiniaturEasy manifest"
+    )
+    parser.add_argument("manifest", nargs="?", default=DEFAULT_MANIFEST)
+    parser.add_argument("--size", type=int, nargs=2, metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--format", choices=sorted(FORMATS))
+    parser.add_argument("--quality", choices=resampling.QUALITIES)
+    parser.add_argument(
+        "--output-dir",
+        help="directory for the thumbnails, keeping their relative directories",
+    )
+    parser.add_argument("--jobs", type=int, help="processes (default: CPU count)")
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="render unchanged sources too, required to overwrite the "
+        "thumbnails in place without --output-dir",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if not args.output_dir and not args.force:
+        parser.error("the thumbnails would be overwritten: use --output-dir or --force")
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+    if args.output_dir and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    rendered, skipped, failed = replay(
+        args.manifest,
+        args.size,
+        args.format,
+        args.quality,
+        args.output_dir,
+        args.jobs,
+        args.force,
+    )
+    print("Rendered: {}, skipped: {}, failed: {}".format(rendered, skipped, failed))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.WARNING)
+    raise SystemExit(main())
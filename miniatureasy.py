@@ -17,8 +17,12 @@ saves thumbnails in JPEG or PNG formats.
 @license: GNU GPL v3
 """
 
+import argparse
+import io
 import logging
 import os
+import timeit
+from concurrent.futures import ThreadPoolExecutor
 
 import wx
 import wx.lib.mixins.rubberband
@@ -26,10 +30,10 @@ import wx.lib.mixins.rubberband
 try:
     from PIL import Image
 except ImportError:
-    try:
-        import Image
-    except ImportError:
-        Image = None
+    Image = None
+
+import manifest
+import resampling
 
 logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.WARNING)
 
@@ -39,9 +43,23 @@ except AttributeError:
     BG_STYLE = wx.BG_STYLE_CUSTOM
 
 try:
-    LANCZOS = Image.Resampling.LANCZOS
+    BICUBIC = Image.Resampling.BICUBIC
 except AttributeError:
-    LANCZOS = Image.ANTIALIAS
+    BICUBIC = Image.BICUBIC
+
+# Image modes carrying an alpha band
+ALPHA_MODES = ("RGBA", "RGBa", "LA", "PA")
+# Image modes that must be converted before resizing: palette, bilevel and
+# high bit depth greyscale images
+NO_RESIZE_MODES = ("1", "P", "PA")
+HIGH_DEPTH_MODES = ("I", "I;16", "I;16B", "I;16L", "I;16N", "F")
+
+# Max size of the cached crop used to render the live previews: twice the
+# max thumbnail size of 3 digits
+CROP_PROXY_SIZE = 1998
+# SaveDialog preview size and delay in ms to render it after an edit
+PREVIEW_SIZE = (200, 200)
+PREVIEW_DELAY = 300
 
 
 class MainFrame(wx.Frame):
@@ -225,13 +243,18 @@ class MainFrame(wx.Frame):
         # Properties
         self.files = []
         self.pil_img = Image.new("RGB", (1, 1))
-        self.has_alpha = False
+        self.proxy_img = self.pil_img
         self.boundingbox = None
         self.zoom = 1
         self.rubberband = wx.lib.mixins.rubberband.RubberBand(self.panel)
         self.img_path = os.getcwd()
         self.save_path = self.img_path
         self.target_size = (200, 200)
+        self.quality = resampling.DEFAULT_QUALITY
+        self.resize_threads = 1
+        self.rotation = 0
+        self.crop_proxy = (None, None)
+        self.manifest_path = manifest.DEFAULT_MANIFEST
         self.index = 0
 
         # Frame size and layout
@@ -252,28 +275,22 @@ class MainFrame(wx.Frame):
         tb1 = wx.FindWindowByName("tb1")
         [tb1.EnableTool(tool_id, boolean) for tool_id in [2, 3, 4]]
 
-    def pil_to_wximage(self, pil):
-        """Convert PIL Image to wx.Image checking if it has alpha channel."""
-        if self.has_alpha:
-            wximage = self._get_wximage_alpha(pil)
+    @staticmethod
+    def pil_to_wximage(pil):
+        """Convert RGB or RGBA PIL Image to wx.Image checking if it has
+        alpha channel."""
+        if pil.mode == "RGBA":
+            wximage = MainFrame._get_wximage_alpha(pil)
         else:
-            wximage = self._get_wximage_noalpha(pil)
+            wximage = MainFrame._get_wximage_noalpha(pil)
 
         return wximage
 
     @staticmethod
     def _get_wximage_alpha(pil):
-        """Private method to convert PIL image with alpha channel to wx.Image."""
-        data = pil.convert("RGB")
-        alpha = pil.convert("RGBA")
-        try:
-            # python3
-            data = data.tobytes()
-            alpha = alpha.tobytes()[3::4]
-        except AttributeError:
-            # python2
-            data = data.tostring()
-            alpha = alpha.tostring()[3::4]
+        """Private method to convert RGBA PIL image to wx.Image."""
+        data = pil.tobytes("raw", "RGB")
+        alpha = pil.tobytes("raw", "A")
 
         try:
             # wxpython phoenix => 3.0.3
@@ -290,16 +307,8 @@ class MainFrame(wx.Frame):
 
     @staticmethod
     def _get_wximage_noalpha(pil):
-        """Private method to convert PIL image with no alpha channel
-        to wx.Image.
-        """
-        data = pil.convert("RGB")
-        try:
-            # python3
-            data = data.tobytes()
-        except AttributeError:
-            # python2
-            data = data.tostring()
+        """Private method to convert RGB PIL image to wx.Image."""
+        data = pil.tobytes()
 
         try:
             # wxpython phoenix => 3.0.3
@@ -320,20 +329,81 @@ class MainFrame(wx.Frame):
         return temp
 
     @staticmethod
-    def pil_thumb_hiq(pil_img, target_w, target_h):
-        """Proportionaly scale image to target size in high quality.
-        with PIL/Pillow."""
-        pil_img.thumbnail((target_w, target_h), LANCZOS)
-        return pil_img
-
-    def set_save_properties(self, save_path, target_size):
-        """Update properties path and size to save the thumb."""
+    def pil_thumb_hiq(
+        pil_img,
+        target_w,
+        target_h,
+        quality=resampling.DEFAULT_QUALITY,
+        threads=1,
+        box=None,
+    ):
+        """Proportionaly scale to target size a COPY of the image, or of its
+        crop box, in high quality with the resampling engine."""
+        return resampling.downscale(pil_img, target_w, target_h, quality, threads, box)
+
+    @staticmethod
+    def pil_has_alpha(pil_img):
+        """Return True if the image has alpha channel or transparency."""
+        return pil_img.mode in ALPHA_MODES or "transparency" in pil_img.info
+
+    @staticmethod
+    def pil_display_proxy(pil_img, max_w, max_h):
+        """Return a display-ready COPY of the image: 8-bit RGB or RGBA,
+        proportionaly scaled down to fit max size in DEFAULT quality.
+
+        The image is converted and resized in one pass, so the display never
+        has to convert it again."""
+        mode = "RGBA" if MainFrame.pil_has_alpha(pil_img) else "RGB"
+        proxy = pil_img
+        if proxy.mode in HIGH_DEPTH_MODES:
+            proxy = MainFrame._pil_to_8bit(proxy)
+        elif proxy.mode in NO_RESIZE_MODES:
+            proxy = proxy.convert(mode)
+
+        src_w, src_h = proxy.size
+        scale = min(float(max_w) / src_w, float(max_h) / src_h, 1)
+        size = (max(int(src_w * scale), 1), max(int(src_h * scale), 1))
+        if size != proxy.size:
+            try:
+                proxy = proxy.resize(size, BICUBIC, reducing_gap=2.0)
+            except TypeError:
+                # PIL/Pillow < 7.0
+                proxy = proxy.resize(size, BICUBIC)
+
+        if proxy.mode != mode:
+            proxy = proxy.convert(mode)
+        elif proxy is pil_img:
+            proxy = proxy.copy()
+        return proxy
+
+    @staticmethod
+    def _pil_to_8bit(pil_img):
+        """Private method to map a high bit depth greyscale image to 8-bit.
+
+        16-bit values are shifted to their 8 high bits and 32-bit integer or
+        float values are clamped to 0-255, as they are exported."""
+        mode = pil_img.mode
+        if mode != "F":
+            pil_img = pil_img.convert("I")
+        if mode.startswith("I;16"):
+            pil_img = pil_img.point(lambda value: value * (1 / 256.0))
+        return pil_img.convert("L")
+
+    def update_proxy(self):
+        """Build the display proxy at screen resolution from the loaded image.
+
+        The loaded image is kept untouched to export the thumbnails."""
+        self.proxy_img = self.pil_display_proxy(self.pil_img, *wx.GetDisplaySize())
+
+    def set_save_properties(self, save_path, target_size, quality):
+        """Update properties path, size and quality to save the thumb."""
         self.save_path = save_path
         self.target_size = target_size
+        self.quality = quality
 
     def get_save_properties(self):
-        """Return thumbnail save properties path and size."""
-        return self.save_path, self.target_size
+        """Return thumbnail save properties path, size and quality."""
+        return self.save_path, self.target_size, self.quality
 
     def on_files_dialog(self, evt=None):
         """Open standard multiselect FileDialog and load first file."""
@@ -367,6 +437,7 @@ GIF files (*.gif)|*.gif"
             msg = "Cannot open the file\n{}".format(self.img_path)
             wx.MessageDialog(self, msg, "Read error", wx.OK | wx.ICON_ERROR).ShowModal()
             self.pil_img = Image.new("RGB", (1, 1))
+            self.update_proxy()
             return
         except MemoryError:
             msg = """Not enought memory to open the file\n{}
@@ -375,6 +446,7 @@ GIF files (*.gif)|*.gif"
                 self, msg, "Memory error", wx.OK | wx.ICON_ERROR
             ).ShowModal()
             self.pil_img = Image.new("RGB", (1, 1))
+            self.update_proxy()
             return
         else:
             try:
@@ -385,7 +457,7 @@ GIF files (*.gif)|*.gif"
                 self.pil_img = Image.new("RGB", (1, 1))
                 # return
 
-        self.has_alpha = self.pil_img.mode == "RGBA"
+        self.update_proxy()
         self.update_drawing()
         self.enable_tbbuttons(True)
         text = "{} - {}/{}".format(self.img_path, index + 1, len(self.files))
@@ -410,12 +482,13 @@ GIF files (*.gif)|*.gif"
     def on_save_thumbnail(self, evt):
         """Open SaveDialog, get a high quality thumbnail from the image and
         save to disk."""
-        dlg = SaveDialog(self, -1, "Save thumbnail as...", size=(400, 450))
+        dlg = SaveDialog(self, -1, "Save thumbnail as...", size=(400, 530))
         if dlg.ShowModal() == wx.ID_CANCEL:
             return
 
         logging.info("Save as: %s", self.save_path)
         logging.info("Thumb size: %s", self.target_size)
+        logging.info("Quality: %s", self.quality)
         if not self.save_path:
             return
         elif os.path.exists(self.save_path):
@@ -428,14 +501,16 @@ GIF files (*.gif)|*.gif"
                 self.statusbar.SetStatusText("Canceled, not saved", 0)
                 return
 
-        cropped_img = self.get_cropped_img()
-        img_w, img_h = cropped_img.size
         target_w, target_h = self.target_size
-        if img_w > target_w * 2 or img_h > target_h * 2:
-            # Step 1: Thumb to double the target size with default quality
-            cropped_img = self.pil_thumb_loq(cropped_img, target_w * 2, target_h * 2)
-        # Step 2: Thumb to target size with best quality
-        thumb = self.pil_thumb_hiq(cropped_img, target_w, target_h)
+        crop_box = self.get_crop_box()
+        thumb = self.pil_thumb_hiq(
+            self.pil_img,
+            target_w,
+            target_h,
+            self.quality,
+            self.resize_threads,
+            crop_box,
+        )
         # Save file
         self.statusbar.SetStatusText("Saving...", 0)
         try:
@@ -459,10 +534,34 @@ Check target size: {}""".format(self.save_path, self.target_size)
         else:
             text = "Saved: {}".format(self.save_path)
             self.statusbar.SetStatusText(text, 0)
+            self.record_thumbnail(crop_box)
+
+    def record_thumbnail(self, crop_box):
+        """Append the saved thumbnail crop and settings to the manifest."""
+        if not self.manifest_path:
+            return
+        try:
+            entry = manifest.make_entry(
+                self.img_path,
+                self.pil_img.size,
+                crop_box,
+                self.rotation,
+                self.target_size,
+                self.quality,
+                self.save_path,
+            )
+            manifest.append_entry(self.manifest_path, entry)
+        except (IOError, OSError):
+            logging.error("Cannot write manifest: %s", self.manifest_path)
 
     def get_cropped_img(self):
+        """Return cropped image or full image if no rubberband is drawn."""
+        return self.pil_img.crop(self.get_crop_box())
+
+    def get_crop_box(self):
         """Get rubberband coords removing borders exceeding the boundingbox.
-        Return cropped image or full image if no rubberband is drawn."""
+        Return the crop box in image coords or the full image box if no
+        rubberband is drawn."""
         try:
             left, top, right, bottom = self.rubberband.getCurrentExtent()
         except TypeError:
@@ -492,19 +591,17 @@ Check target size: {}""".format(self.save_path, self.target_size)
             right - self.boundingbox.left,
             bottom - self.boundingbox.top,
         )
-        cropped_img = self.pil_img.crop(
-            (
-                int(left / self.zoom),
-                int(top / self.zoom),
-                int(right / self.zoom),
-                int(bottom / self.zoom),
-            )
+        return (
+            int(left / self.zoom),
+            int(top / self.zoom),
+            int(right / self.zoom),
+            int(bottom / self.zoom),
         )
-        return cropped_img
 
     def clear_all(self):
-        """Reset the rubberband extent and zoom scale."""
+        """Reset the rubberband extent, zoom scale and rotation."""
         self.zoom = 1
+        self.rotation = 0
         self.clear_rb()
 
     def clear_rb(self):
@@ -533,7 +630,7 @@ Check target size: {}""".format(self.save_path, self.target_size)
         panel_size = self.panel.GetSize()
         source_size = self.pil_img.size
 
-        thumb = self.pil_thumb_loq(self.pil_img, *panel_size)
+        thumb = self.pil_thumb_loq(self.proxy_img, *panel_size)
 
         wx_img = self.pil_to_wximage(thumb)
 
@@ -576,16 +673,46 @@ Check target size: {}""".format(self.save_path, self.target_size)
         bmp, position = self.get_resized_center_bmp()
         dc.DrawBitmap(bmp, *position)
 
-    def get_preview_img(self, size=(200, 200)):
+    def get_preview_img(self, size=PREVIEW_SIZE):
         """Return a default quality, resized preview of the cropped image
-        in wxpython image format."""
-        preview = self.pil_thumb_loq(self.get_cropped_img(), size[0], size[1])
+        in wxpython image format.
+
+        The preview is cropped from the display proxy, never from the
+        full size image."""
+        scale_w = float(self.proxy_img.size[0]) / self.pil_img.size[0]
+        scale_h = float(self.proxy_img.size[1]) / self.pil_img.size[1]
+        left, top, right, bottom = self.get_crop_box()
+        proxy_box = (
+            int(left * scale_w),
+            int(top * scale_h),
+            max(int(right * scale_w), int(left * scale_w) + 1),
+            max(int(bottom * scale_h), int(top * scale_h) + 1),
+        )
+        preview = self.pil_display_proxy(
+            self.proxy_img.crop(proxy_box), size[0], size[1]
+        )
         return self.pil_to_wximage(preview)
 
+    def get_crop_proxy(self, crop_box):
+        """Return a cached COPY of the cropped image downscaled to fit
+        CROP_PROXY_SIZE, to render the previews of any thumbnail size.
+
+        It is built from the full size image only when the crop changes, so
+        call it out of the GUI thread."""
+        key = (self.img_path, self.rotation, crop_box)
+        if self.crop_proxy[0] != key:
+            crop_proxy = resampling.downscale(
+                self.pil_img, CROP_PROXY_SIZE, CROP_PROXY_SIZE, "fast", box=crop_box
+            )
+            self.crop_proxy = (key, crop_proxy)
+        return self.crop_proxy[1]
+
     def on_rotate_right(self, evt):
         """Rotate loaded image 90º to the right then call update_drawing."""
         self.clear_rb()
         self.pil_img = self.pil_img.rotate(-90, expand=True)
+        self.proxy_img = self.proxy_img.rotate(-90, expand=True)
+        self.rotation = (self.rotation + 1) % 4
         self.update_drawing()
 
     @staticmethod
@@ -601,7 +728,7 @@ class SaveDialog(wx.Dialog):
         super(SaveDialog, self).__init__(parent, *args, **kwargs)
 
         self.parent = parent
-        self.save_path, target_size = self.parent.get_save_properties()
+        self.save_path, target_size, quality = self.parent.get_save_properties()
 
         mainsizer = wx.BoxSizer(wx.VERTICAL)
 
@@ -625,8 +752,12 @@ class SaveDialog(wx.Dialog):
 
         # Image preview
         preview = self.parent.get_preview_img().ConvertToBitmap()
-        staticbmp = wx.StaticBitmap(self, wx.ID_ANY, preview, size=(200, 200))
-        mainsizer.Add(staticbmp, -1, wx.ALIGN_CENTER | wx.ALL, 5)
+        self.staticbmp = wx.StaticBitmap(self, wx.ID_ANY, preview, size=PREVIEW_SIZE)
+        mainsizer.Add(self.staticbmp, -1, wx.ALIGN_CENTER | wx.ALL, 5)
+        self.text_preview = wx.StaticText(
+            self, -1, "Rendering preview...", style=wx.ALIGN_CENTER
+        )
+        mainsizer.Add(self.text_preview, 0, wx.EXPAND | wx.LEFT | wx.RIGHT, 5)
 
         # Thumbnail target size
         sizer2 = wx.BoxSizer(wx.VERTICAL)
@@ -656,28 +787,146 @@ class SaveDialog(wx.Dialog):
         sizer2.Add(h_sizer2, 0, wx.ALIGN_CENTER | wx.ALL, 5)
         mainsizer.Add(sizer2, 0, wx.EXPAND)
 
+        # Resampling quality preset
+        h_sizer3 = wx.BoxSizer(wx.HORIZONTAL)
+        label = wx.StaticText(self, -1, "Quality:")
+        self.choice_quality = wx.Choice(
+            self, -1, choices=list(resampling.QUALITIES), name="quality"
+        )
+        self.choice_quality.SetStringSelection(quality)
+        h_sizer3.Add(label, 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 5)
+        h_sizer3.Add(self.choice_quality, 0)
+        mainsizer.Add(h_sizer3, 0, wx.ALIGN_CENTER | wx.ALL, 5)
+
         # Separated buttons sizer
         but_sizer = self.CreateSeparatedButtonSizer(wx.OK | wx.CANCEL)
         mainsizer.Add(but_sizer, 0, wx.ALIGN_CENTER | wx.ALL, 5)
 
         but_id_ok = wx.FindWindowById(wx.ID_OK, self)
-        but_id_close = wx.FindWindowById(wx.ID_CANCEL, self)
         but_id_ok.SetName("OK")
 
         self.SetSizer(mainsizer)
-        self.SetSizeHints(400, 400)
+        self.SetSizeHints(400, 480)
 
         # Event binding
         self.text_size_w.Bind(wx.EVT_CHAR, self.on_keypress)
         self.text_size_h.Bind(wx.EVT_CHAR, self.on_keypress)
         self.button_path.Bind(wx.EVT_LEFT_DOWN, self.on_but_click)
-        but_id_ok.Bind(wx.EVT_LEFT_DOWN, self.on_ok)
-        but_id_close.Bind(wx.EVT_LEFT_DOWN, self.on_close)
+        # Button events are sent by the keyboard too: Enter and Escape
+        self.Bind(wx.EVT_BUTTON, self.on_ok, id=wx.ID_OK)
+        self.Bind(wx.EVT_BUTTON, self.on_close, id=wx.ID_CANCEL)
         self.Bind(wx.EVT_TEXT_ENTER, self.on_text_enter)
         self.Bind(wx.EVT_CLOSE, self.on_close)
+        self.text_path.Bind(wx.EVT_TEXT, self.on_preview_edit)
+        self.text_size_w.Bind(wx.EVT_TEXT, self.on_preview_edit)
+        self.text_size_h.Bind(wx.EVT_TEXT, self.on_preview_edit)
+        self.choice_quality.Bind(wx.EVT_CHOICE, self.on_preview_edit)
+
+        # Live preview rendered in background from the cached crop proxy
+        self.crop_box = self.parent.get_crop_box()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.generation = 0
+        self.preview_timer = None
+        self.previewing = True
+        self.start_preview()
 
         self.text_path.SetFocus()
 
+    @staticmethod
+    def get_format(save_path):
+        """Return the PIL/Pillow format the thumbnail will be saved in."""
+        return "PNG" if save_path.endswith(".png") else "JPEG"
+
+    def on_preview_edit(self, evt):
+        """Render the preview again when the edits stop for PREVIEW_DELAY."""
+        evt.Skip()
+        if not self.previewing:
+            return
+        if self.preview_timer:
+            self.preview_timer.Stop()
+        self.preview_timer = wx.CallLater(PREVIEW_DELAY, self.start_preview)
+
+    def start_preview(self):
+        """Queue the render of the preview with the current values."""
+        if not self.previewing:
+            return
+        self.generation += 1
+        try:
+            target_size = (
+                int(self.text_size_w.GetValue()),
+                int(self.text_size_h.GetValue()),
+            )
+        except ValueError:
+            self.text_preview.SetLabel("")
+            return
+        if not all(target_size):
+            self.text_preview.SetLabel("")
+            return
+        self.text_preview.SetLabel("Rendering preview...")
+        self.executor.submit(
+            self.render_preview,
+            self.generation,
+            target_size,
+            self.choice_quality.GetStringSelection(),
+            self.get_format(self.text_path.GetValue()),
+        )
+
+    def render_preview(self, generation, target_size, quality, fmt):
+        """Render and encode the thumbnail out of the GUI thread and send
+        the results to on_preview_ready."""
+        if generation != self.generation:
+            # Outdated by a newer edit
+            return
+        try:
+            crop_proxy = self.parent.get_crop_proxy(self.crop_box)
+            thumb = self.parent.pil_thumb_hiq(crop_proxy, *target_size, quality=quality)
+            data = io.BytesIO()
+            start = timeit.default_timer()
+            try:
+                thumb.save(data, fmt, optimize=True)
+            except (IOError, OSError, SystemError):
+                info = "Cannot save as {}".format(fmt)
+            else:
+                info = "{}x{} px, {} {:.1f} KB, encoded in {:.0f} ms".format(
+                    thumb.size[0],
+                    thumb.size[1],
+                    fmt,
+                    data.tell() / 1024.0,
+                    (timeit.default_timer() - start) * 1000,
+                )
+            preview = self.parent.pil_display_proxy(thumb, *PREVIEW_SIZE)
+        except Exception:
+            # The executor drops the errors, report them here
+            logging.exception("Cannot render preview")
+            wx.CallAfter(
+                self.on_preview_ready, generation, None, "Cannot render preview"
+            )
+            return
+        wx.CallAfter(self.on_preview_ready, generation, preview, info)
+
+    def on_preview_ready(self, generation, preview, info):
+        """Show the rendered preview, or only the info if it failed, if no
+        newer edit was made."""
+        if generation != self.generation:
+            return
+        if preview is not None:
+            self.staticbmp.SetBitmap(
+                self.parent.pil_to_wximage(preview).ConvertToBitmap()
+            )
+        self.text_preview.SetLabel(info)
+        self.Layout()
+
+    def end_preview(self):
+        """Stop rendering previews, however the dialog is closed."""
+        if not self.previewing:
+            return
+        self.previewing = False
+        if self.preview_timer:
+            self.preview_timer.Stop()
+            self.preview_timer = None
+        self.generation += 1
+        self.executor.shutdown(wait=False)
+
     @staticmethod
     def on_keypress(evt):
         """Avoid non numerical characters."""
@@ -779,17 +1028,43 @@ class SaveDialog(wx.Dialog):
             int(self.text_size_w.GetValue()),
             int(self.text_size_h.GetValue()),
         )
-        self.parent.set_save_properties(self.save_path, target_size)
+        quality = self.choice_quality.GetStringSelection()
+        self.parent.set_save_properties(self.save_path, target_size, quality)
+        self.end_preview()
         self.EndModal(wx.ID_OK)
 
     def on_close(self, evt):
         """Cancel dialog."""
+        self.end_preview()
         self.EndModal(wx.ID_CANCEL)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MiniaturEasy thumbnail creator")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="threads used to reduce and resize huge images (default: 1)",
+    )
+    parser.add_argument(
+        "--manifest",
+        default=manifest.DEFAULT_MANIFEST,
+        help="file to record the saved thumbnails (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-manifest",
+        dest="manifest",
+        action="store_const",
+        const=None,
+        help="do not record the saved thumbnails",
+    )
+    args = parser.parse_args()
+
     app = wx.App(redirect=False)
     app.locale = wx.Locale(wx.LANGUAGE_DEFAULT)
     frame = MainFrame(None, title="MiniaturEasy - Thumbnail creator")
+    frame.resize_threads = args.threads
+    frame.manifest_path = args.manifest
     frame.Show()
     app.MainLoop()
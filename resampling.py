@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""
+MiniaturEasy resampling engine
+
+High quality downscaling of PIL/Pillow images without wxPython, so it can be
+used by the GUI and by headless tools alike.
+
+The bulk of the reduction is done with an integer factor box reduce(), which
+is cheap and exact, and the remaining scale is done with a single LANCZOS
+pass. The reduction is stopped `gap` times above the target size so the
+LANCZOS pass still has enough pixels to work with: the bigger the gap, the
+closer the result is to a pure LANCZOS resize and the slower it gets.
+
+Huge images can optionaly be reduced and resized by a pool of threads
+working on strips, as PIL/Pillow releases the GIL while resampling. The
+result is identical to the serial one.
+
+@author: Benito López
+@license: GNU GPL v3
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+try:
+    LANCZOS = Image.Resampling.LANCZOS
+    BICUBIC = Image.Resampling.BICUBIC
+    NEAREST = Image.Resampling.NEAREST
+except AttributeError:
+    LANCZOS = Image.ANTIALIAS
+    BICUBIC = Image.BICUBIC
+    NEAREST = Image.NEAREST
+
+# Quality/speed presets: (reducing gap, final resampling filter).
+# A None gap means no box reduction at all: pure LANCZOS.
+PRESETS = {
+    "fast": (1.5, BICUBIC),
+    "balanced": (2.0, LANCZOS),
+    "best": (3.0, LANCZOS),
+    "exact": (None, LANCZOS),
+}
+QUALITIES = ("fast", "balanced", "best", "exact")
+DEFAULT_QUALITY = "balanced"
+
+# Image modes that reduce() can't handle, they are resized in one pass
+NO_REDUCE_MODES = ("1", "P", "I;16", "I;16B", "I;16L", "I;16N")
+# Image modes resized with premultiplied alpha
+PREMULTIPLIED_MODES = {"RGBA": "RGBa", "LA": "La"}
+
+# Minimum output rows or columns of every strip of a parallel resize
+MIN_STRIP_ROWS = 32
+# Source rows around the box read by the widest filter (LANCZOS) per unit
+# of downscaling
+MAX_SUPPORT = 3
+
+
+def fit_size(source_size, target_w, target_h):
+    """Return the size that proportionaly fits the source size into target
+    size. Images are never upscaled."""
+    source_w, source_h = source_size
+    scale = min(float(target_w) / source_w, float(target_h) / source_h, 1)
+    return max(int(round(source_w * scale)), 1), max(int(round(source_h * scale)), 1)
+
+
+def reduce_factor(source_size, size, gap):
+    """Return the integer box reduce() factor that keeps the image at least
+    `gap` times bigger than size, or 1 if no reduction is worth it."""
+    if gap is None:
+        return 1
+    factor = min(float(source_size[0]) / size[0], float(source_size[1]) / size[1])
+    return max(int(factor / gap), 1)
+
+
+def downscale(
+    pil_img, target_w, target_h, quality=DEFAULT_QUALITY, threads=1, box=None
+):
+    """Return a NEW image proportionaly scaled to fit target size.
+
+    `box` is the integer crop box of the source image to scale, the whole
+    image by default. The source image is never modified and only the box
+    is read, without cropping it first: the filter reads the pixels around
+    the box like resize(box=). RGBA and LA boxes are copied once to
+    premultiply their alpha. An image already fitting target size is
+    returned as a cropped copy. `quality` is one of the PRESETS names and
+    `threads` the number of threads of both the reduce() and the
+    resampling passes."""
+    gap, resample = PRESETS[quality]
+    box = tuple(box) if box else (0, 0) + pil_img.size
+    box_size = (box[2] - box[0], box[3] - box[1])
+    size = fit_size(box_size, target_w, target_h)
+    if size == box_size:
+        return pil_img.crop(box)
+
+    mode = pil_img.mode
+    if mode in NO_REDUCE_MODES:
+        return pil_img.resize(size, resample, box=box)
+
+    img = pil_img
+    if mode in PREMULTIPLIED_MODES:
+        # Premultiply once instead of the whole image on every reduce and
+        # resize call: only the box and the pixels around read by the filter
+        scale = max(float(box_size[0]) / size[0], float(box_size[1]) / size[1])
+        margin = int(MAX_SUPPORT * scale) + 2
+        region = (
+            max(box[0] - margin, 0),
+            max(box[1] - margin, 0),
+            min(box[2] + margin, img.size[0]),
+            min(box[3] + margin, img.size[1]),
+        )
+        img = img.crop(region).convert(PREMULTIPLIED_MODES[mode])
+        left, top = region[:2]
+        box = (box[0] - left, box[1] - top, box[2] - left, box[3] - top)
+
+    factor = reduce_factor(box_size, size, gap)
+    if factor > 1:
+        try:
+            if threads > 1:
+                img = reduce_parallel(img, factor, threads, box)
+            else:
+                img = img.reduce(factor, box=box)
+        except AttributeError:
+            # PIL/Pillow < 7.0
+            pass
+        else:
+            # reduce() rounds the size up, keep the exact source extent
+            box = (0, 0, float(box_size[0]) / factor, float(box_size[1]) / factor)
+
+    if threads > 1:
+        img = resize_parallel(img, size, resample, box, threads)
+    else:
+        img = img.resize(size, resample, box=box)
+    if img.mode != mode:
+        img = img.convert(mode)
+    return img
+
+
+def strip_bounds(length, strips, first=0):
+    """Return the (first, last) rows or columns of every strip."""
+    edges = [first + length * index // strips for index in range(strips + 1)]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def map_strips(function, bounds):
+    """Return function results of every strip bounds computed concurrently."""
+    with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+        return list(executor.map(function, bounds))
+
+
+def reduce_parallel(pil_img, factor, threads=None, box=None):
+    """Return a NEW image like pil_img.reduce(factor, box=box) reducing
+    horizontal strips concurrently.
+
+    Strips start on multiples of factor, so the result is identical to the
+    serial reduce(). `threads` defaults to the CPU count."""
+    threads = threads or os.cpu_count() or 1
+    left, top, right, bottom = box or (0, 0) + pil_img.size
+    out_h = -(-(bottom - top) // factor)
+    strips = min(threads, out_h // MIN_STRIP_ROWS)
+    if strips < 2:
+        return pil_img.reduce(factor, box=(left, top, right, bottom))
+    # Decode lazy loaded images before sharing them between threads
+    pil_img.load()
+
+    def reduce_strip(bounds):
+        first, last = bounds
+        strip_box = (
+            left,
+            top + first * factor,
+            right,
+            min(top + last * factor, bottom),
+        )
+        return first, pil_img.reduce(factor, box=strip_box)
+
+    img = Image.new(pil_img.mode, (-(-(right - left) // factor), out_h))
+    for first, strip in map_strips(reduce_strip, strip_bounds(out_h, strips)):
+        img.paste(strip, (0, first))
+    return img
+
+
+def resize_parallel(pil_img, size, resample=LANCZOS, box=None, threads=None):
+    """Return a NEW image resized like pil_img.resize(size, resample, box)
+    splitting both resampling passes in strips resized concurrently.
+
+    The horizontal pass resizes strips of source rows and the vertical pass
+    strips of columns of its result, so every strip uses the very same
+    filter coefficients as the serial resize and the result is identical.
+    `threads` defaults to the CPU count."""
+    threads = threads or os.cpu_count() or 1
+    if box is None:
+        box = (0, 0) + pil_img.size
+    out_w, out_h = size
+    strips = min(threads, out_w // MIN_STRIP_ROWS, out_h // MIN_STRIP_ROWS)
+    if strips < 2 or resample == NEAREST or pil_img.mode in NO_REDUCE_MODES:
+        return pil_img.resize(size, resample, box=box)
+
+    mode = pil_img.mode
+    if mode in PREMULTIPLIED_MODES:
+        # Premultiply once instead of on every strip
+        pil_img = pil_img.convert(PREMULTIPLIED_MODES[mode])
+    pil_img.load()
+
+    width, height = pil_img.size
+    left, top, right, bottom = box
+    # Source rows read by the vertical pass: the box plus the filter support
+    margin = MAX_SUPPORT * max(float(bottom - top) / out_h, 1) + 1
+    first_row = max(int(top - margin), 0)
+    last_row = min(int(bottom + margin) + 1, height)
+
+    def resize_rows(bounds):
+        first, last = bounds
+        rows = pil_img.crop((0, first, width, last))
+        return first, rows.resize(
+            (out_w, last - first), resample, (left, 0, right, last - first)
+        )
+
+    # Horizontal pass, keeping the source rows position so the vertical
+    # pass gets the same coefficients as the serial one
+    temp = Image.new(pil_img.mode, (out_w, height))
+    row_bounds = strip_bounds(last_row - first_row, strips, first_row)
+    for first, strip in map_strips(resize_rows, row_bounds):
+        temp.paste(strip, (0, first))
+
+    def resize_columns(bounds):
+        first, last = bounds
+        columns = temp.crop((first, 0, last, height))
+        return first, columns.resize(
+            (last - first, out_h), resample, (0, top, last - first, bottom)
+        )
+
+    # Vertical pass
+    img = Image.new(pil_img.mode, size)
+    for first, strip in map_strips(resize_columns, strip_bounds(out_w, strips)):
+        img.paste(strip, (first, 0))
+
+    if img.mode != mode:
+        img = img.convert(mode)
+    return img
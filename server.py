@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+
+"""
+MiniaturEasy thumbnail server
+
+Local HTTP service rendering thumbnails on demand with the same resampling
+engine the GUI uses to save them:
+
+    python server.py --root IMAGES_DIR [--port 8080] [--workers N]
+
+    GET /thumb?src=photo.jpg&w=200&h=200[&crop=L,T,R,B][&q=best][&fmt=png]
+
+`src` is relative to the root directory, `crop` is a box in source image
+pixels that must be inside the image and `q` one of the resampling quality
+presets.
+
+Renders run on a bounded process pool. Concurrent identical requests wait
+for a single render, and thumbnails are served again from a LRU memory
+cache and a disk cache, both limited in size, with an ETag to answer 304
+Not Modified.
+
+@author: Benito López
+@license: GNU GPL v3
+"""
+
+import argparse
+import asyncio
+import collections
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+
+import resampling
+
+# Thumbnail formats: (PIL/Pillow format, content type)
+FORMATS = {"jpg": ("JPEG", "image/jpeg"), "png": ("PNG", "image/png")}
+# Image modes that can be saved as JPEG
+JPEG_MODES = ("1", "L", "RGB", "CMYK")
+# Max thumbnail width and height
+MAX_SIZE = 4096
+# Max source images whose size is kept in memory
+MAX_SOURCE_SIZES = 4096
+REASONS = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
+
+
+class BadRequest(Exception):
+    """Invalid thumbnail request."""
+
+
+def render_thumbnail(path, size, crop, quality, fmt):
+    """Return the encoded thumbnail of an image file."""
+    img = Image.open(path)
+    thumb = resampling.downscale(img, size[0], size[1], quality, box=crop)
+    pil_format = FORMATS[fmt][0]
+    if pil_format == "JPEG" and thumb.mode not in JPEG_MODES:
+        thumb = thumb.convert("RGB")
+    data = io.BytesIO()
+    thumb.save(data, pil_format, optimize=True)
+    return data.getvalue()
+
+
+class LRUCache(object):
+    """Memory cache of encoded thumbnails limited in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.items = collections.OrderedDict()
+
+    def get(self, key):
+        """Return the cached value or None, marking it as recently used."""
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """Cache a value dropping the least recently used ones."""
+        if len(value) > self.max_bytes:
+            return
+        if key in self.items:
+            self.nbytes -= len(self.items.pop(key))
+        self.items[key] = value
+        self.nbytes += len(value)
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= len(self.items.popitem(last=False)[1])
+
+
+class DiskCache(object):
+    """Directory cache of encoded thumbnails limited in bytes, dropping the
+    least recently used ones. Safe to use from several threads."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.files = collections.OrderedDict()
+        self.lock = threading.Lock()
+        cached = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+            elif os.path.isfile(path):
+                stat = os.stat(path)
+                cached.append((stat.st_mtime, name, stat.st_size))
+        for _, name, nbytes in sorted(cached):
+            self.files[name] = nbytes
+            self.nbytes += nbytes
+        self.evict()
+
+    def get(self, key):
+        """Return the cached file content or None, marking it as recently
+        used."""
+        with self.lock:
+            if key not in self.files:
+                return None
+            self.files.move_to_end(key)
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, "rb") as cached:
+                data = cached.read()
+            # Keep the use order across restarts
+            os.utime(path, None)
+        except (IOError, OSError):
+            # Evicted meanwhile
+            return None
+        return data
+
+    def put(self, key, data):
+        """Write a file atomically, so readers never get a partial one, and
+        drop the least recently used files over the size limit."""
+        if len(data) > self.max_bytes:
+            return
+        path = os.path.join(self.directory, key)
+        temp_path = "{}.{}.tmp".format(path, threading.current_thread().ident)
+        with open(temp_path, "wb") as cached:
+            cached.write(data)
+        os.replace(temp_path, path)
+        with self.lock:
+            self.nbytes -= self.files.pop(key, 0)
+            self.files[key] = len(data)
+            self.nbytes += len(data)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used files over the size limit."""
+        with self.lock:
+            evicted = []
+            while self.nbytes > self.max_bytes:
+                name, nbytes = self.files.popitem(last=False)
+                self.nbytes -= nbytes
+                evicted.append(name)
+        for name in evicted:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+class ThumbnailServer(object):
+    """Asyncio HTTP server of thumbnails."""
+
+    def __init__(
+        self,
+        root,
+        cache_dir,
+        workers=None,
+        memory_cache=64 << 20,
+        disk_cache=1 << 30,
+    ):
+        self.root = os.path.realpath(root)
+        self.disk = DiskCache(cache_dir, disk_cache)
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.memory = LRUCache(memory_cache)
+        self.inflight = {}
+        self.source_sizes = {}
+
+    def parse_query(self, query):
+        """Return the source pathname and the render arguments of a query."""
+        params = {key: values[-1] for key, values in parse_qs(query).items()}
+        try:
+            src = params["src"]
+            size = (int(params["w"]), int(params["h"]))
+            crop = params.get("crop")
+            crop = tuple(int(value) for value in crop.split(",")) if crop else None
+        except (KeyError, ValueError):
+            raise BadRequest("src, w and h are required, crop is L,T,R,B")
+        quality = params.get("q", resampling.DEFAULT_QUALITY)
+        fmt = params.get("fmt", "jpg")
+        if not (0 < size[0] <= MAX_SIZE and 0 < size[1] <= MAX_SIZE):
+            raise BadRequest("w and h must be 1 to {}".format(MAX_SIZE))
+        if crop and (len(crop) != 4 or crop[0] >= crop[2] or crop[1] >= crop[3]):
+            raise BadRequest("crop must be L,T,R,B")
+        if quality not in resampling.PRESETS:
+            raise BadRequest(
+                "q must be one of {}".format(", ".join(resampling.QUALITIES))
+            )
+        if fmt not in FORMATS:
+            raise BadRequest("fmt must be one of {}".format(", ".join(sorted(FORMATS))))
+
+        path = os.path.realpath(os.path.join(self.root, src))
+        if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+            raise LookupError(src)
+        return path, size, crop, quality, fmt
+
+    @staticmethod
+    def source_stamp(path):
+        """Return the pathname, modification time and size of a file."""
+        stat = os.stat(path)
+        return path, stat.st_mtime, stat.st_size
+
+    async def source_size(self, stamp):
+        """Return the width and height of a source image, reading only its
+        header the first time."""
+        image_size = self.source_sizes.get(stamp)
+        if image_size is None:
+            loop = asyncio.get_event_loop()
+            image_size = await loop.run_in_executor(None, read_image_size, stamp[0])
+            if len(self.source_sizes) >= MAX_SOURCE_SIZES:
+                self.source_sizes.clear()
+            self.source_sizes[stamp] = image_size
+        return image_size
+
+    @staticmethod
+    def etag(stamp, size, crop, quality, fmt):
+        """Return the ETag of a thumbnail, changing with its source file."""
+        key = repr((stamp, size, crop, quality, fmt))
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    async def get_thumbnail(self, etag, args):
+        """Return the encoded thumbnail from the caches or rendering it.
+
+        Concurrent requests of the same thumbnail share a single render."""
+        data = self.memory.get(etag)
+        if data is not None:
+            return data
+        task = self.inflight.get(etag)
+        if task is None:
+            task = asyncio.ensure_future(self.load_thumbnail(etag, args))
+            self.inflight[etag] = task
+            task.add_done_callback(lambda _: self.inflight.pop(etag, None))
+        return await asyncio.shield(task)
+
+    async def load_thumbnail(self, etag, args):
+        """Return the thumbnail from the disk cache or render and cache it."""
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(None, self.disk.get, etag)
+        if data is None:
+            data = await loop.run_in_executor(self.executor, render_thumbnail, *args)
+            try:
+                await loop.run_in_executor(None, self.disk.put, etag, data)
+            except (IOError, OSError) as error:
+                logging.warning("Cannot write disk cache: %s", error)
+        self.memory.put(etag, data)
+        return data
+
+    async def handle_thumb(self, method, target, headers):
+        """Return the status, headers and body answering a thumb request."""
+        try:
+            args = self.parse_query(urlsplit(target).query)
+        except BadRequest as error:
+            return 400, {}, str(error).encode("utf-8")
+        except LookupError:
+            return 404, {}, b"Image not found"
+        stamp = self.source_stamp(args[0])
+        try:
+            width, height = await self.source_size(stamp)
+        except Exception as error:
+            logging.error("Cannot read image: %s (%s)", args[0], error)
+            return 500, {}, b"Cannot read image"
+        crop = args[2]
+        if crop and (crop[0] < 0 or crop[1] < 0 or crop[2] > width or crop[3] > height):
+            message = "crop must be inside the {}x{} image".format(width, height)
+            return 400, {}, message.encode("utf-8")
+        etag = '"{}"'.format(self.etag(stamp, *args[1:]))
+        response_headers = {
+            "ETag": etag,
+            "Cache-Control": "no-cache",
+            "Content-Type": FORMATS[args[-1]][1],
+        }
+        if headers.get("if-none-match") == etag:
+            return 304, response_headers, b""
+        try:
+            data = await self.get_thumbnail(etag.strip('"'), args)
+        except Exception as error:
+            # Never leave the client without a response
+            logging.error("Cannot create thumbnail: %s (%s)", args[0], error)
+            return 500, {}, b"Cannot create thumbnail"
+        return 200, response_headers, data
+
+    async def handle_connection(self, reader, writer):
+        """Serve the HTTP/1.1 requests of a client connection."""
+        try:
+            while True:
+                try:
+                    request_line, headers = await self.read_request(reader)
+                except (ValueError, asyncio.LimitOverrunError):
+                    # A line over the stream limit can't be skipped
+                    await self.send(writer, 400, {}, b"Request too long", True)
+                    break
+                if not request_line.strip():
+                    break
+
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self.send(writer, 400, {}, b"Bad request line", True)
+                    break
+                keep_alive = headers.get("connection", "").lower() != "close" and (
+                    version == "HTTP/1.1"
+                )
+                if method not in ("GET", "HEAD"):
+                    status, response_headers, body = 405, {"Allow": "GET, HEAD"}, b""
+                elif urlsplit(target).path != "/thumb":
+                    status, response_headers, body = 404, {}, b"Not found"
+                else:
+                    try:
+                        status, response_headers, body = await self.handle_thumb(
+                            method, target, headers
+                        )
+                    except Exception:
+                        logging.exception("Cannot answer: %s", target)
+                        status, response_headers, body = 500, {}, b"Server error"
+                await self.send(
+                    writer, status, response_headers, body, not keep_alive, method
+                )
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_request(reader):
+        """Return the request line and the headers by lowercase name."""
+        request_line = await reader.readline()
+        headers = {}
+        if not request_line.strip():
+            return request_line, headers
+        while True:
+            line = await reader.readline()
+            if not line.strip():
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return request_line, headers
+
+    @staticmethod
+    async def send(writer, status, headers, body, close, method="GET"):
+        """Write an HTTP response. HEAD responses get the headers of the GET
+        one without the body."""
+        lines = ["HTTP/1.1 {} {}".format(status, REASONS[status])]
+        headers = dict(headers, **{"Content-Length": str(len(body))})
+        if close:
+            headers["Connection"] = "close"
+        lines.extend("{}: {}".format(name, value) for name, value in headers.items())
+        if method == "HEAD":
+            body = b""
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def serve(self, host, port):
+        """Serve requests forever."""
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logging.warning(
+            "Serving thumbnails of %s on http://%s:%s", self.root, host, port
+        )
+        async with server:
+            await server.serve_forever()
+
+
+def read_image_size(path):
+    """Return the width and height of an image file reading its header."""
+    with Image.open(path) as img:
+        return img.size
+
+
+def main():
+    """Parse the command line and run the server."""
+    parser = argparse.ArgumentParser(description="MiniaturEasy thumbnail server")
+    parser.add_argument("--root", default=os.getcwd(), help="images directory")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, help="processes (default: CPU count)")
+    parser.add_argument(
+        "--cache-dir",
+        default=os.path.join(tempfile.gettempdir(), "miniatureasy-cache"),
+    )
+    parser.add_argument(
+        "--memory-cache", type=int, default=64, help="memory cache size in MB"
+    )
+    parser.add_argument(
+        "--disk-cache", type=int, default=1024, help="disk cache size in MB"
+    )
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.cache_dir):
+        os.makedirs(args.cache_dir)
+    server = ThumbnailServer(
+        args.root,
+        args.cache_dir,
+        args.workers,
+        args.memory_cache << 20,
+        args.disk_cache << 20,
+    )
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.executor.shutdown()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.WARNING)
+    main()